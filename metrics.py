@@ -0,0 +1,320 @@
+import os
+import json
+import time
+import threading
+from collections import defaultdict
+
+# Upper bounds (in seconds) for the histogram buckets
+DURATION_BUCKETS = [1, 5, 15, 30, 60, 120, 300, 600, 900, 1800]
+LOAD_BUCKETS = [0.1, 0.5, 1, 2, 5, 10, 30, 60]
+
+# Set in each worker by init_worker so that play_game can report events
+_event_queue = None
+
+
+def init_worker(queue):
+    """Pool initializer. Stores the event queue used by emit"""
+    global _event_queue
+    _event_queue = queue
+
+
+def emit(event, **fields):
+    """Send an event to the parent process. Does nothing if metrics are disabled"""
+    if _event_queue is None:
+        return
+    fields["event"] = event
+    fields["pid"] = os.getpid()
+    _event_queue.put(fields)
+
+
+def _format_value(value):
+    # Integers are written in full, floats with enough digits to round-trip
+    value = float(value)
+    if value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in labels
+    )
+    return "{" + pairs + "}"
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class Metrics:
+    """
+    Thread-safe store of counters, gauges and histograms, keyed by name and labels
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.histograms = {}
+        self.help = {}
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, buckets, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets)
+            self.histograms[key].observe(value)
+
+    def to_prometheus(self):
+        lines = []
+        seen = set()
+
+        def header(name, kind):
+            if name in seen:
+                return
+            seen.add(name)
+            if name in self.help:
+                lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                header(name, "counter")
+                lines.append(
+                    f"{name}{_format_labels(labels)} {_format_value(value)}"
+                )
+            for (name, labels), value in sorted(self.gauges.items()):
+                header(name, "gauge")
+                lines.append(
+                    f"{name}{_format_labels(labels)} {_format_value(value)}"
+                )
+            for (name, labels), hist in sorted(self.histograms.items()):
+                header(name, "histogram")
+                for bound, count in zip(hist.buckets, hist.counts):
+                    bucket_labels = labels + (("le", f"{bound:g}"),)
+                    lines.append(
+                        f"{name}_bucket{_format_labels(bucket_labels)} {count}"
+                    )
+                inf_labels = labels + (("le", "+Inf"),)
+                lines.append(f"{name}_bucket{_format_labels(inf_labels)} {hist.count}")
+                lines.append(
+                    f"{name}_sum{_format_labels(labels)} {_format_value(hist.sum)}"
+                )
+                lines.append(f"{name}_count{_format_labels(labels)} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self):
+        def entry(name, labels, **values):
+            return dict(name=name, labels=dict(labels), **values)
+
+        with self.lock:
+            counters = [
+                entry(name, labels, value=value)
+                for (name, labels), value in sorted(self.counters.items())
+            ]
+            gauges = [
+                entry(name, labels, value=value)
+                for (name, labels), value in sorted(self.gauges.items())
+            ]
+            histograms = [
+                entry(
+                    name,
+                    labels,
+                    buckets=dict(zip([f"{b:g}" for b in hist.buckets], hist.counts)),
+                    count=hist.count,
+                    sum=hist.sum,
+                )
+                for (name, labels), hist in sorted(self.histograms.items())
+            ]
+        return {
+            "timestamp": time.time(),
+            "counters": counters,
+            "gauges": gauges,
+            "histograms": histograms,
+        }
+
+
+class TournamentMetrics:
+    """
+    Collects the events sent by the workers and periodically exports the metrics,
+    either as a Prometheus textfile (overwritten) or as JSON lines (appended)
+    """
+
+    def __init__(self, queue, path, fmt="prometheus", interval=15):
+        self.queue = queue
+        self.path = path
+        self.fmt = fmt
+        self.interval = interval
+        self.metrics = Metrics()
+        self.scheduled = 0
+        self.started = 0
+        # Workers with a game in progress, mapped to whether they were missing at the last check
+        self.in_progress = {}
+        self._workers_lock = threading.Lock()
+        self.interrupted = False
+        self._stop = threading.Event()
+        self._threads = []
+
+        m = self.metrics
+        m.describe("reconchess_games_started_total", "Games started by the workers")
+        m.describe(
+            "reconchess_games_completed_total", "Games played to the end, by reason"
+        )
+        m.describe("reconchess_games_errored_total", "Games that errored, by reason")
+        m.describe("reconchess_game_duration_seconds", "Wall time of each game")
+        m.describe(
+            "reconchess_submission_load_seconds", "Time taken to load a submission"
+        )
+        m.describe("reconchess_queue_depth", "Scheduled games not yet started")
+        m.describe(
+            "reconchess_worker_restarts_total",
+            "Workers that exited without finishing their game",
+        )
+        m.describe("reconchess_replay_bytes_written_total", "Bytes of replays saved")
+
+    def schedule(self, num_games):
+        self.scheduled += num_games
+        self._update_queue_depth()
+
+    def _update_queue_depth(self):
+        self.metrics.set(
+            "reconchess_queue_depth", max(0, self.scheduled - self.started)
+        )
+
+    def handle(self, event):
+        m = self.metrics
+        kind = event["event"]
+        if kind == "game_started":
+            with self._workers_lock:
+                self.in_progress[event["pid"]] = False
+            self.started += 1
+            m.inc("reconchess_games_started_total")
+            self._update_queue_depth()
+        elif kind == "submission_loaded":
+            m.observe(
+                "reconchess_submission_load_seconds",
+                event["seconds"],
+                LOAD_BUCKETS,
+                submission=event["submission"],
+            )
+        elif kind == "game_finished":
+            with self._workers_lock:
+                self.in_progress.pop(event["pid"], None)
+            if event["error"]:
+                m.inc("reconchess_games_errored_total", reason=event["reason"])
+            else:
+                m.inc("reconchess_games_completed_total", reason=event["reason"])
+            # Games that failed to load never started play, so they would skew the durations
+            if event["played"]:
+                m.observe(
+                    "reconchess_game_duration_seconds",
+                    event["duration"],
+                    DURATION_BUCKETS,
+                    reason=event["reason"],
+                )
+        elif kind == "replay_saved":
+            m.inc("reconchess_replay_bytes_written_total", event["bytes"])
+
+    def _collect(self):
+        while True:
+            event = self.queue.get()
+            if event is None:
+                break
+            self.handle(event)
+
+    def check_workers(self, final=False):
+        """
+        Count workers that died during a game. Every worker plays a single game, so a
+        worker that is gone without reporting game_finished exited abnormally. A worker
+        must be missing at two consecutive checks, since its game_finished event may
+        still be in the queue. Once the queue is drained (final), one check is enough
+        """
+        with self._workers_lock:
+            if self.interrupted:
+                return
+            for pid, missing in list(self.in_progress.items()):
+                if _pid_exists(pid):
+                    continue
+                if missing or final:
+                    del self.in_progress[pid]
+                    self.metrics.inc("reconchess_worker_restarts_total")
+                else:
+                    self.in_progress[pid] = True
+
+    def interrupt(self):
+        """
+        Call before terminating the pool, so that the workers killed mid-game are not
+        counted as abnormal exits
+        """
+        with self._workers_lock:
+            self.interrupted = True
+            self.in_progress.clear()
+
+    def _export_loop(self):
+        while not self._stop.wait(self.interval):
+            self.check_workers()
+            self.export()
+
+    def export(self):
+        if self.fmt == "json":
+            with open(self.path, "a") as f:
+                f.write(json.dumps(self.metrics.to_dict()) + "\n")
+        else:
+            # Write to a temporary file first so that a scraper never sees a partial file
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.write(self.metrics.to_prometheus())
+            os.replace(tmp_path, self.path)
+
+    def start(self):
+        self._update_queue_depth()
+        self._threads = [
+            threading.Thread(target=self._collect, daemon=True),
+            threading.Thread(target=self._export_loop, daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        # The sentinel is queued after every worker event, so the collector drains them all
+        self.queue.put(None)
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout=5)
+        self.check_workers(final=True)
+        self.export()
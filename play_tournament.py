@@ -1,6 +1,12 @@
 import os
 import glob
+import time
+import json
+import random
+import numpy as np
+import zlib
 from reconchess import load_player, play_local_game, LocalGame
+from reconchess.history import GameHistoryEncoder
 import chess
 import traceback
 from functools import wraps
@@ -12,10 +18,13 @@ from dotenv import load_dotenv
 import re
 from leaderboard_from_files import print_leaderboard, read_results
 import argparse
+import metrics
 
 load_dotenv()
 
 SECONDS_PER_PLAYER = 60 * 7
+FULL_TURN_LIMIT = 50
+REVERSIBLE_MOVES_LIMIT = 100
 
 
 def redirect_output(filename):
@@ -133,22 +142,44 @@ class Submission:
 
 args = None
 
-def load_submission(filename):
+
+def game_seed(base_seed, white_sub, black_sub):
+    """
+    Derive the seed of a game from the tournament seed and the pairing, so that it
+    does not depend on the order in which the games are scheduled
+    """
+    key = f"{base_seed}:{white_sub.name.lower()}:{black_sub.name.lower()}"
+    return zlib.crc32(key.encode())
+
+
+def seed_game(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+def load_submission(filename, submission_name):
     sub_name = None
     sub_class = None
     error = None
+    start = time.monotonic()
     try:
         sub_name, sub_class = load_player(filename)
     except:
         tb = traceback.format_exc()
         error = tb
+    metrics.emit(
+        "submission_loaded",
+        submission=submission_name,
+        seconds=time.monotonic() - start,
+    )
 
     return sub_name, sub_class, error
 
 
-def save_replay(white_sub, black_sub, winner, history=None, tb=None):
+def save_replay(white_sub, black_sub, winner, history=None, tb=None, seed=None):
     """
     winner is either "white", "black", or "draw"
+    seed is the seed the game was played with, if any
     """
     if args.replay_dir:
         replay_dir = args.replay_dir
@@ -174,28 +205,51 @@ def save_replay(white_sub, black_sub, winner, history=None, tb=None):
     replay_name = f"{white_name}_{black_name}.json"
     replay_path = os.path.join(replay_dir, replay_name)
 
-    if history:
+    if history and seed is None:
         history.save(replay_path)
+    elif history:
+        # GameHistory only saves its own fields, so encode it the same way and add the
+        # seed. GameHistoryDecoder ignores the extra key when the replay is loaded
+        replay = GameHistoryEncoder().default(history)
+        replay["seed"] = seed
+        with open(replay_path, "w") as f:
+            json.dump(replay, f, cls=GameHistoryEncoder)
     elif tb:
         replay_name = f"{white_name}_{black_name}-ERROR.json"
         replay_path = os.path.join(replay_dir, replay_name)
         # Just save the traceback in the json file
         with open(replay_path, "w") as f:
+            if seed is not None:
+                f.write(f"Seed: {seed}\n")
             f.write(tb)
             f.close()
+    else:
+        return
 
+    metrics.emit("replay_saved", bytes=os.path.getsize(replay_path))
 
-def play_game(white_submission, black_submission):
+
+def play_game(white_submission, black_submission, seed=None):
     """
     returns winner_submission
     """
+    # Seed before the submissions are loaded, since they may use randomness at import time
+    if seed is not None:
+        seed_game(seed)
+
+    metrics.emit(
+        "game_started", white=white_submission.name, black=black_submission.name
+    )
+    start = time.monotonic()
+    error = False
+    played = False
 
     #  Load the white submission and black submission
     white_cls_name, white_player_cls, white_error = load_submission(
-        white_submission.filename
+        white_submission.filename, white_submission.name
     )
     black_cls_name, black_player_cls, black_error = load_submission(
-        black_submission.filename
+        black_submission.filename, black_submission.name
     )
 
     win_reason = None
@@ -206,6 +260,7 @@ def play_game(white_submission, black_submission):
     if white_error is not None or black_error is not None:
         tb = None
         win_reason = "Load Error"
+        error = True
         if white_error is not None and black_error is not None:
             # Both submissions failed to load. Consider it a draw
             winner = None
@@ -219,19 +274,23 @@ def play_game(white_submission, black_submission):
             tb = black_error
 
         if tb:
-            save_replay(white_submission, black_submission, winner, tb=tb)
+            save_replay(white_submission, black_submission, winner, tb=tb, seed=seed)
 
     else:
 
         # Create the game
         game = LocalGame(
-            seconds_per_player=SECONDS_PER_PLAYER, full_turn_limit=50
+            seconds_per_player=SECONDS_PER_PLAYER,
+            full_turn_limit=FULL_TURN_LIMIT,
+            reversible_moves_limit=REVERSIBLE_MOVES_LIMIT,
         )  # Make this 60 * 7 seconds for the full one
 
         # Play the game
+        seed_info = f" (seed {seed})" if seed is not None else ""
         print(
-            f"{Style.DIM}Playing {white_submission.name} vs {black_submission.name}{Style.RESET_ALL}"
+            f"{Style.DIM}Playing {white_submission.name} vs {black_submission.name}{seed_info}{Style.RESET_ALL}"
         )
+        played = True
         try:
             white_obj = white_player_cls()
             black_obj = black_player_cls()
@@ -249,10 +308,11 @@ def play_game(white_submission, black_submission):
                     else black_submission
                 )
 
-            save_replay(white_submission, black_submission, winner, history)
+            save_replay(white_submission, black_submission, winner, history, seed=seed)
         except:
             tb = traceback.format_exc()
             win_reason = "Runtime Error"
+            error = True
             # One of the submissions had an error in their execution. Give the win to the other player
             winner = None
             if white_submission.name in tb:
@@ -264,11 +324,25 @@ def play_game(white_submission, black_submission):
                 print(
                     f"{white_submission.name} vs {black_submission.name}-{Fore.RED}INTERNAL ERROR{Style.RESET_ALL}"
                 )
+                win_reason = "Internal Error"
 
-            save_replay(white_submission, black_submission, winner, tb=tb)
+            save_replay(white_submission, black_submission, winner, tb=tb, seed=seed)
 
             game.end()
 
+    # Label errors in the same style as the WinReason names, e.g. "Load Error" -> LOAD_ERROR
+    if isinstance(win_reason, str):
+        reason = win_reason.upper().replace(" ", "_")
+    else:
+        reason = win_reason.name
+    metrics.emit(
+        "game_finished",
+        reason=reason,
+        error=error,
+        played=played,
+        duration=time.monotonic() - start,
+    )
+
     if winner:
         print(
             f"{Fore.GREEN}Winner: {Style.BRIGHT}{winner.name}{Style.NORMAL}, Reason: {win_reason}{Style.RESET_ALL}"
@@ -296,12 +370,50 @@ if __name__ == "__main__":
         "--rerun-timeouts", help="Rerun games that timed out", default="./replays"
     )
     parser.add_argument(
-        "--replay-dir", help="Directory to save replays", default="./replays"
+        "--replay-dir",
+        help="Directory to save replays. Defaults to ./replays, or ./replays-game with --game",
+        default=None,
+    )
+    parser.add_argument(
+        "--seed",
+        help="Tournament seed. Every game is seeded from it and its pairing",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--game",
+        help="Play only the game between these two submissions",
+        nargs=2,
+        metavar=("WHITE", "BLACK"),
+        default=None,
+    )
+    parser.add_argument(
+        "--metrics-file",
+        help="File to periodically export tournament metrics to",
+        default=None,
+    )
+    parser.add_argument(
+        "--metrics-format",
+        help="Export metrics as a Prometheus textfile or as JSON lines",
+        choices=["prometheus", "json"],
+        default="prometheus",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        help="Seconds between metrics exports",
+        type=float,
+        default=15,
     )
     args = parser.parse_args()
 
+    # Keep single game reruns apart from the tournament's replays, which read_results counts
+    if args.replay_dir is None:
+        args.replay_dir = "./replays-game" if args.game else "./replays"
+
     submissions = {}
     playable_round = []
+    # Seeds recorded in the replays of games that are rerun, keyed by (white, black)
+    recorded_seeds = {}
 
     # Get all directories (i.e. student submissions) in the submission directory
     student_submission_dirs = glob.glob(os.path.join(args.submission_directory, "*"))
@@ -317,8 +429,27 @@ if __name__ == "__main__":
         bot_id = i + num_human_subs
         submissions[bot_id] = Submission(bot_id, bot_name=bot)
 
-        # Check if we have to run a tournament with just the games that timed out
-    if args.rerun_timeouts:
+    if args.game:
+        white_sub = None
+        black_sub = None
+        for sub in submissions.values():
+            if sub.name.lower() == args.game[0].lower():
+                white_sub = sub
+            elif sub.name.lower() == args.game[1].lower():
+                black_sub = sub
+        if white_sub is None or black_sub is None:
+            parser.error(f"Could not find the submissions for {args.game}")
+        if not white_sub.is_valid() or not black_sub.is_valid():
+            parser.error(f"{white_sub.name} vs {black_sub.name} has an invalid submission")
+        if args.seed is None:
+            print(
+                f"{Fore.YELLOW}Warning: --game without --seed plays the game unseeded. "
+                f"Pass the tournament's --seed to reproduce the original game{Style.RESET_ALL}"
+            )
+        playable_round.append((white_sub.id, black_sub.id))
+
+    # Check if we have to run a tournament with just the games that timed out
+    elif args.rerun_timeouts:
         # Read in every file in the replay directory
         replay_files = glob.glob(os.path.join(args.rerun_timeouts, "*.json"))
         for replay_file in replay_files:
@@ -341,6 +472,18 @@ if __name__ == "__main__":
                         elif sub.name.lower() == black_name.lower():
                             black_sub = sub
 
+                    # Rerun with the same seed if the game was seeded
+                    if contents.startswith("Seed: "):
+                        # Error replays start with the seed before the traceback
+                        seed = int(contents.split("\n", 1)[0][len("Seed: ") :])
+                    else:
+                        try:
+                            seed = json.loads(contents).get("seed")
+                        except ValueError:
+                            seed = None
+                    if seed is not None:
+                        recorded_seeds[(white_sub.id, black_sub.id)] = seed
+
                     # Add the game to the playable_round
                     playable_round.append((white_sub.id, black_sub.id))
     else:
@@ -373,7 +516,34 @@ if __name__ == "__main__":
 
     print(f"Playing {len(playable_round)} games")
 
-    pool = MyPool(processes=10, maxtasksperchild=1)
+    seeds = {}
+    for white, black in playable_round:
+        if (white, black) in recorded_seeds:
+            seeds[(white, black)] = recorded_seeds[(white, black)]
+        elif args.seed is not None:
+            seeds[(white, black)] = game_seed(
+                args.seed, submissions[white], submissions[black]
+            )
+        else:
+            seeds[(white, black)] = None
+
+    num_processes = 10
+    tournament_metrics = None
+    pool_kwargs = {}
+    if args.metrics_file:
+        tournament_metrics = metrics.TournamentMetrics(
+            multiprocessing.Queue(),
+            args.metrics_file,
+            fmt=args.metrics_format,
+            interval=args.metrics_interval,
+        )
+        tournament_metrics.schedule(len(playable_round))
+        tournament_metrics.start()
+        pool_kwargs = dict(
+            initializer=metrics.init_worker, initargs=(tournament_metrics.queue,)
+        )
+
+    pool = MyPool(processes=num_processes, maxtasksperchild=1, **pool_kwargs)
     # Create a leaderboard
     points = {i: 0 for i in submissions.keys()}
 
@@ -381,7 +551,7 @@ if __name__ == "__main__":
         for winner in pool.starmap(
             play_game,
             [
-                (submissions[white], submissions[black])
+                (submissions[white], submissions[black], seeds[(white, black)])
                 for white, black in playable_round
             ],
             chunksize=1,
@@ -392,14 +562,20 @@ if __name__ == "__main__":
         points = {submissions[k].name: v for k, v in points.items()}
     except KeyboardInterrupt:
         print("Caught KeyboardInterrupt, terminating workers")
+        if tournament_metrics:
+            tournament_metrics.interrupt()
         pool.terminate()
 
         points = read_results()
     finally:
         pool.close()
+        if tournament_metrics:
+            pool.join()
+            tournament_metrics.stop()
 
     # for white, black in playable_round:
     #     winner = play_game(submissions[white], submissions[black])
     #     results.append(winner)
 
-    print_leaderboard(points, save_csv=True)
+    # A single game rerun must not replace the tournament's leaderboard.csv
+    print_leaderboard(points, save_csv=not args.game)
@@ -0,0 +1,258 @@
+import os
+import sys
+import glob
+import argparse
+import multiprocessing
+import chess
+from reconchess import GameHistory
+from reconchess.utilities import (
+    add_pawn_queen_promotion,
+    capture_square_of_move,
+    move_actions,
+    revise_move,
+)
+from colorama import Fore, Style
+from play_tournament import FULL_TURN_LIMIT, REVERSIBLE_MOVES_LIMIT
+
+
+def recorded_result(replay_file):
+    """
+    Read the result from the replay name, the same way the leaderboard does.
+    Returns (white_name, black_name, winner_color, is_error) where winner_color is None for a draw
+    """
+    filename = os.path.basename(replay_file)[:-5]
+    white, black = filename.split("-")[0].split("_")
+    is_error = filename.endswith("-ERROR")
+
+    winner_color = None
+    if white.upper() == white:
+        winner_color = chess.WHITE
+    elif black.upper() == black:
+        winner_color = chess.BLACK
+    return white, black, winner_color, is_error
+
+
+def error_winner(tb, white, black):
+    """
+    Rerun play_game's heuristic on a traceback: the first submission named in it is
+    blamed, checking white first. Returns (winner_color, ambiguous). The replay names
+    have had their case changed, so the names are matched case-insensitively
+    """
+    tb = tb.lower()
+    white_named = white.lower() in tb
+    black_named = black.lower() in tb
+    if white_named:
+        winner_color = chess.BLACK
+    elif black_named:
+        winner_color = chess.WHITE
+    else:
+        winner_color = None
+    return winner_color, white_named == black_named
+
+
+def describe(color):
+    return "draw" if color is None else chess.COLOR_NAMES[color]
+
+
+def resimulate(history):
+    """
+    Replay the taken moves of history on a fresh board and return (board, problems)
+    """
+    problems = []
+    board = chess.Board()
+    for turn in history.turns():
+        if board.king(chess.WHITE) is None or board.king(chess.BLACK) is None:
+            problems.append(f"{turn}: game continued after a king was captured")
+            break
+
+        if not history.has_move(turn):
+            # The game ended during this turn (e.g. a timeout) before a move was made
+            break
+
+        if turn.color != board.turn:
+            problems.append(f"{turn}: expected {chess.COLOR_NAMES[board.turn]} to move")
+            break
+
+        before = history.truth_board_before_move(turn)
+        if before.board_fen() != board.board_fen():
+            problems.append(f"{turn}: recorded board before the move does not match")
+            break
+
+        requested = history.requested_move(turn)
+        taken = history.taken_move(turn)
+        # Work out the taken move from the requested move the same way LocalGame does
+        if requested is None:
+            expected_taken = None
+        elif requested not in move_actions(board):
+            problems.append(f"{turn}: requested move {requested} is not a move action")
+            break
+        else:
+            expected_taken = revise_move(
+                board, add_pawn_queen_promotion(board, requested)
+            )
+        if taken != expected_taken:
+            problems.append(
+                f"{turn}: requested {requested} should give {expected_taken}, "
+                f"but {taken} was taken"
+            )
+            break
+
+        capture_square = capture_square_of_move(board, taken)
+        if capture_square != history.capture_square(turn):
+            problems.append(
+                f"{turn}: recorded capture square {history.capture_square(turn)}, "
+                f"re-simulated {capture_square}"
+            )
+
+        board.push(taken if taken is not None else chess.Move.null())
+
+        after = history.truth_board_after_move(turn)
+        if after.board_fen() != board.board_fen():
+            problems.append(f"{turn}: recorded board after the move does not match")
+            break
+
+    return board, problems
+
+
+def verify_replay(replay_file):
+    """
+    Returns (replay_file, status, problems) where status is "ok", "mismatch",
+    "ambiguous" or "skipped"
+    """
+    try:
+        white, black, recorded_winner, is_error = recorded_result(replay_file)
+    except ValueError:
+        return replay_file, "skipped", ["replay name is not <white>_<black>.json"]
+
+    if is_error:
+        # Error replays only contain a traceback, so there is no game to re-simulate.
+        # Check the winner that was given from the names in the traceback instead
+        with open(replay_file, "r") as f:
+            tb = f.read()
+        winner_color, ambiguous = error_winner(tb, white, black)
+        if winner_color != recorded_winner:
+            return (
+                replay_file,
+                "mismatch",
+                [
+                    f"file records {describe(recorded_winner)}, "
+                    f"traceback gives {describe(winner_color)}"
+                ],
+            )
+        if ambiguous:
+            named = "both" if winner_color is not None else "neither"
+            return (
+                replay_file,
+                "ambiguous",
+                [f"traceback names {named} of the submissions"],
+            )
+        return replay_file, "ok", []
+
+    try:
+        history = GameHistory.from_file(replay_file)
+    except Exception as e:
+        return replay_file, "mismatch", [f"could not read game history: {e!r}"]
+
+    if history.is_empty():
+        return replay_file, "mismatch", ["game history is empty"]
+
+    try:
+        board, problems = resimulate(history)
+    except Exception as e:
+        return replay_file, "mismatch", [f"could not re-simulate game: {e!r}"]
+
+    winner_color = history.get_winner_color()
+    win_reason = history.get_win_reason()
+    reason = win_reason.name if win_reason is not None else None
+
+    if reason is None:
+        problems.append("game history has no win reason")
+    elif reason == "KING_CAPTURE":
+        if winner_color is None or board.king(not winner_color) is not None:
+            problems.append("KING_CAPTURE recorded but the loser's king is on the board")
+        elif board.king(winner_color) is None:
+            problems.append("KING_CAPTURE recorded but the winner's king was captured")
+    elif board.king(chess.WHITE) is None or board.king(chess.BLACK) is None:
+        problems.append(f"{reason} recorded but a king was captured")
+    elif reason == "TURN_LIMIT" and board.fullmove_number <= FULL_TURN_LIMIT:
+        problems.append(
+            f"TURN_LIMIT recorded but the game stopped at turn {board.fullmove_number}"
+        )
+    elif reason == "MOVE_LIMIT" and board.halfmove_clock < REVERSIBLE_MOVES_LIMIT:
+        problems.append(
+            f"MOVE_LIMIT recorded after only {board.halfmove_clock} reversible moves"
+        )
+
+    # Whatever the reason, the game must not have continued past either limit
+    if board.fullmove_number > FULL_TURN_LIMIT + 1:
+        problems.append(
+            f"game continued past the turn limit to turn {board.fullmove_number}"
+        )
+    if board.halfmove_clock > REVERSIBLE_MOVES_LIMIT:
+        problems.append(
+            f"game continued past the move limit to {board.halfmove_clock} "
+            "reversible moves"
+        )
+
+    # play_game scores a TURN_LIMIT as a draw regardless of the recorded winner
+    expected_winner = None if reason == "TURN_LIMIT" else winner_color
+    if expected_winner != recorded_winner:
+        problems.append(
+            f"file records {describe(recorded_winner)}, "
+            f"game history gives {describe(expected_winner)} ({reason})"
+        )
+
+    return replay_file, "mismatch" if problems else "ok", problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Verify replays by re-simulating the recorded games"
+    )
+    parser.add_argument(
+        "replays_dir",
+        type=str,
+        help="Directory containing the replay files",
+        nargs="?",
+        default="./replays",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        help="Number of processes to verify with",
+        default=os.cpu_count(),
+    )
+    parser.add_argument(
+        "--show-skipped",
+        help="Print the replays that were skipped",
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    files = sorted(glob.glob(os.path.join(args.replays_dir, "*.json")))
+    print(f"Found {len(files)} replay files")
+
+    counts = {"ok": 0, "mismatch": 0, "ambiguous": 0, "skipped": 0}
+    with multiprocessing.Pool(processes=args.processes) as pool:
+        for replay_file, status, problems in pool.imap_unordered(
+            verify_replay, files, chunksize=8
+        ):
+            counts[status] += 1
+            if status == "mismatch":
+                print(f"{Fore.RED}{os.path.basename(replay_file)}{Style.RESET_ALL}")
+            elif status == "ambiguous":
+                print(f"{Fore.YELLOW}{os.path.basename(replay_file)}{Style.RESET_ALL}")
+            elif status == "skipped" and args.show_skipped:
+                print(f"{Style.DIM}{os.path.basename(replay_file)}{Style.RESET_ALL}")
+            else:
+                continue
+            for problem in problems:
+                print(f"    {problem}")
+
+    print(
+        f"{Fore.GREEN}{counts['ok']} ok{Style.RESET_ALL}, "
+        f"{Fore.RED}{counts['mismatch']} mismatched{Style.RESET_ALL}, "
+        f"{Fore.YELLOW}{counts['ambiguous']} ambiguous tracebacks{Style.RESET_ALL}, "
+        f"{counts['skipped']} skipped"
+    )
+    sys.exit(1 if counts["mismatch"] or counts["ambiguous"] else 0)